@@ -6,42 +6,94 @@ answer with inline [N] citations. Compatible with modern LlamaIndex.
 Usage:
   python main.py --pdf notes.pdf --query "Summarize with citations."
   python main.py --pdf a.pdf b.pdf --query "Main findings?" --top-k 5
+  python main.py --pdf a.pdf --queries "What methods?" "What limitations?"
 """
 
+from __future__ import annotations
+
 import argparse
 import asyncio
+import functools
+import hashlib
+import importlib.util
+import io
+import mmap
+import multiprocessing
 import os
+import re
+import shelve
+import shutil
+import sqlite3
 import sys
-from typing import List, Tuple
-
-# --- LlamaIndex imports with compatibility fallbacks ---
-from llama_index.core import VectorStoreIndex, PromptTemplate
-try:
-    # get_response_synthesizer lives here on modern versions
-    from llama_index.core.response_synthesizers import get_response_synthesizer
-    try:
-        # Some versions still expose ResponseMode here
-        from llama_index.core.response_synthesizers import ResponseMode  # type: ignore
-    except Exception:
-        ResponseMode = None  # we'll pass a string instead
-except Exception:
-    # Older fallback
-    from llama_index.core import get_response_synthesizer  # type: ignore
-    ResponseMode = None
-
-# SimpleDirectoryReader can be re-exported from core or live in readers.file
-try:
-    from llama_index.core import SimpleDirectoryReader
-except Exception:
-    from llama_index.readers.file import SimpleDirectoryReader  # type: ignore
-
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.schema import TextNode, NodeWithScore
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+# LlamaIndex, tiktoken, pypdf, httpx and faiss are imported inside the functions that use
+# them, so `--help` and argument errors return without paying their import cost.
+if TYPE_CHECKING:
+    import httpx
+    from llama_index.core import Document
+    from llama_index.core.node_parser import SentenceSplitter
+    from llama_index.core.schema import NodeWithScore, TextNode
 
 CITATION_CHUNK_SIZE = 80
 CITATION_CHUNK_OVERLAP = 10
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_BATCH_SIZE = 256
+EMBED_WORKERS = 8
+EMBED_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+DEFAULT_CACHE_DIR = ".rag_cache"
+RERANK_MODEL = "BAAI/bge-reranker-base"
+RERANK_CANDIDATES = 4  # with --rerank, retrieve top_k * this many candidates for the cross-encoder
+MAX_CONCURRENT_QUERIES = 8
+SINGLE_SHOT_CONTEXT_TOKENS = 12000  # upper bound on context synthesized in one LLM call (no refine pass)
+SINGLE_SHOT_MARGIN_TOKENS = 64  # headroom for PromptHelper padding and chat-message framing
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE = 32
+HTTP_TIMEOUT = 60.0
+QUERY_CACHE_TTL = 300  # seconds a cached answer stays valid
+QUERY_CACHE_SIZE = 128
+PDF_MMAP_THRESHOLD = 32 * 1024 * 1024  # mmap PDFs larger than this instead of reading them into memory
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    """One BPE table shared by the citation splitter and llama-index's token counting."""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=None)
+def _faiss_available() -> bool:
+    """Optional FAISS HNSW vector store; without it the default in-memory store is used.
+
+    Probed with find_spec so cache keys can be computed without importing faiss/numpy.
+    """
+    try:
+        return (importlib.util.find_spec("faiss") is not None
+                and importlib.util.find_spec("llama_index.vector_stores.faiss") is not None)
+    except (ImportError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def _faiss():
+    import faiss  # type: ignore
+    import numpy as np
+    from llama_index.vector_stores.faiss import FaissVectorStore  # type: ignore
+    return faiss, np, FaissVectorStore
+
+def _vector_store_kind() -> str:
+    return "faiss-hnsw-sq8" if _faiss_available() else "simple"
 
 # CITATION_QA_TEMPLATE = PromptTemplate(
 #     "Please provide an answer based solely on the provided sources. "
@@ -94,7 +146,7 @@ CITATION_CHUNK_OVERLAP = 10
 #     "Answer: "
 # )
 
-CITATION_QA_TEMPLATE = PromptTemplate(
+CITATION_QA_PROMPT = (
     """You are a careful analyst. Use ONLY the numbered sources to answer.
 Each time you use information, cite it inline as [N]. If multiple sources support a claim, include multiple citations.
 
@@ -112,7 +164,7 @@ Rules:
 Answer with inline citations:"""
 )
 
-CITATION_REFINE_TEMPLATE = PromptTemplate(
+CITATION_REFINE_PROMPT = (
     """We are refining an existing answer using NEW numbered sources.
 Use the new sources to improve or correct the answer. Preserve correct parts.
 
@@ -129,127 +181,627 @@ Rules:
 Refined answer with inline citations:"""
 )
 
+class QueryCache:
+    """Thread-safe LRU cache with a per-entry TTL, persisted to a shelve file between runs."""
+
+    def __init__(self, path: str, maxsize: int = QUERY_CACHE_SIZE):
+        self._path = path
+        self._maxsize = maxsize
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        now = time.time()
+        with shelve.open(path) as db:
+            live = [(k, v) for k, v in db.items() if v[0] > now]
+        # Oldest-expiring first approximates the LRU order of the previous run
+        for key, entry in sorted(live, key=lambda kv: kv[1][0])[-maxsize:]:
+            self._entries[key] = entry
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, ttl: float = QUERY_CACHE_TTL) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        with self._lock, shelve.open(self._path) as db:
+            for key in set(db.keys()) - set(self._entries):
+                del db[key]
+            db.update(self._entries)
+
+@functools.lru_cache(maxsize=None)
+def _cached_embedding_class():
+    """Define CachedOpenAIEmbedding on first use, once llama-index has been imported."""
+    from llama_index.core.bridge.pydantic import PrivateAttr
+    from llama_index.embeddings.openai import OpenAIEmbedding
+
+    class CachedOpenAIEmbedding(OpenAIEmbedding):
+        """OpenAIEmbedding that looks up each text in a local SQLite cache before calling the API.
+
+        Entries are keyed by sha256(model + "\\0" + text), so unchanged chunks of an edited PDF
+        are never re-embedded. Query embeddings are not cached.
+        """
+
+        _db_path: str = PrivateAttr()
+
+        def __init__(self, db_path: str, **kwargs):
+            super().__init__(**kwargs)
+            self._db_path = db_path
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            with closing(sqlite3.connect(db_path)) as conn, conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (h BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+
+        def _lookup(self, texts: List[str]) -> Tuple[List[bytes], List[Optional[List[float]]]]:
+            keys = [hashlib.sha256(f"{self.model_name}\0{t}".encode()).digest() for t in texts]
+            if not keys:
+                return [], []
+            with closing(sqlite3.connect(self._db_path)) as conn:
+                rows = dict(conn.execute(
+                    f"SELECT h, vec FROM embeddings WHERE h IN ({','.join('?' * len(keys))})", keys
+                ))
+            return keys, [array("f", rows[k]).tolist() if k in rows else None for k in keys]
+
+        def _store(self, keys: List[bytes], vectors: List[List[float]]) -> None:
+            with closing(sqlite3.connect(self._db_path)) as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (h, vec) VALUES (?, ?)",
+                    [(k, array("f", v).tobytes()) for k, v in zip(keys, vectors)],
+                )
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            keys, vectors = self._lookup(texts)
+            misses = [i for i, v in enumerate(vectors) if v is None]
+            if misses:
+                fresh = super()._get_text_embeddings([texts[i] for i in misses])
+                self._store([keys[i] for i in misses], fresh)
+                for i, v in zip(misses, fresh):
+                    vectors[i] = v
+            return vectors
+
+        async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            keys, vectors = self._lookup(texts)
+            misses = [i for i, v in enumerate(vectors) if v is None]
+            if misses:
+                fresh = await super()._aget_text_embeddings([texts[i] for i in misses])
+                self._store([keys[i] for i in misses], fresh)
+                for i, v in zip(misses, fresh):
+                    vectors[i] = v
+            return vectors
+
+    return CachedOpenAIEmbedding
+
+def _make_http_client() -> httpx.AsyncClient:
+    """One pooled async client shared by the embedding and chat calls."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+    try:
+        # HTTP/2 multiplexes concurrent requests over a single connection
+        return httpx.AsyncClient(http2=True, limits=limits, timeout=HTTP_TIMEOUT)
+    except ImportError:
+        # http2=True needs the optional h2 package; pooled HTTP/1.1 still reuses connections
+        return httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT)
+
+def _make_embed_model(cache_dir: Optional[str], http_client: Optional[httpx.AsyncClient] = None):
+    from llama_index.embeddings.openai import OpenAIEmbedding
+
+    # Large batches sent concurrently (num_workers bounds the in-flight async requests)
+    kwargs = dict(
+        model=EMBED_MODEL,
+        embed_batch_size=EMBED_BATCH_SIZE,
+        num_workers=EMBED_WORKERS,
+        async_http_client=http_client,
+    )
+    if not cache_dir:
+        return OpenAIEmbedding(**kwargs)
+    return _cached_embedding_class()(db_path=os.path.join(cache_dir, "embeddings.sqlite"), **kwargs)
+
+def _resolve_pdf(path: str) -> str:
+    os.stat(path)  # raises OSError (missing, unreadable, bad path) on the first bad file
+    return os.path.abspath(path)
+
+def _parse_pdf(path: str) -> List[Tuple[str, str]]:
+    """Extract (text, page_label) for each page of one PDF, parsed from an in-memory buffer.
+
+    Imports only pypdf and returns plain tuples, so it stays cheap to run in a spawned worker.
+    """
+    import pypdf
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > PDF_MMAP_THRESHOLD:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = io.BytesIO(f.read())
+    with buf:
+        pdf = pypdf.PdfReader(buf)
+        labels = pdf.page_labels  # property that rebuilds the full list on every access
+        return [(page.extract_text() or "", labels[i]) for i, page in enumerate(pdf.pages)]
+
+def _pages_to_documents(path: str, pages: List[Tuple[str, str]]) -> List[Document]:
+    """One Document per page.
+
+    Like SimpleDirectoryReader + PDFReader, file_name is kept in metadata but excluded from
+    the embed and LLM text, so only page_label and file_path end up in chunk content.
+    """
+    from llama_index.core import Document
+
+    file_name = os.path.basename(path)
+    return [
+        Document(
+            text=text,
+            metadata={"page_label": label, "file_name": file_name, "file_path": path},
+            excluded_embed_metadata_keys=["file_name"],
+            excluded_llm_metadata_keys=["file_name"],
+        )
+        for text, label in pages
+    ]
+
 def _load_pdfs(pdf_paths: List[str]):
-    reader = SimpleDirectoryReader(input_files=pdf_paths)
-    return reader.load_data()
+    if len(pdf_paths) < 2:
+        parsed = [_parse_pdf(path) for path in pdf_paths]
+    else:
+        # Parse files in a process pool; map() keeps input order. Workers are spawned rather than
+        # forked: this runs in a worker thread while the event loop is doing HTTPS I/O, and
+        # forking a multi-threaded process can deadlock the child.
+        with ProcessPoolExecutor(
+            max_workers=min(len(pdf_paths), os.cpu_count() or 4),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            parsed = list(pool.map(_parse_pdf, pdf_paths))
+    # Documents are built here so workers never import llama-index
+    return [doc for path, pages in zip(pdf_paths, parsed) for doc in _pages_to_documents(path, pages)]
+
+def _query_cache_key(query: str, top_k: int, chunk_size: int, chunk_overlap: int,
+                     model: str, index_key: str, rerank_model: Optional[str] = None) -> str:
+    parts = (hashlib.sha256(query.encode()).hexdigest(), top_k, chunk_size, chunk_overlap, model,
+             index_key, rerank_model)
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+def _index_cache_key(pdf_paths: List[str], embed_model_name: str) -> str:
+    """Hash each PDF's resolved path and contents together with the embedding model and store kind.
+
+    The path is part of the key because cached nodes carry the file_path they were built from;
+    a moved or copied PDF must not reuse an index (and source map) pointing at the old location.
+    """
+    h = hashlib.sha256()
+    for path in sorted(os.path.abspath(p) for p in pdf_paths):
+        h.update(path.encode() + b"\0")
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(block)
+        h.update(file_hash.digest())
+    h.update(f"{embed_model_name}:{_vector_store_kind()}".encode())
+    return h.hexdigest()
+
+def _new_storage_context(embed_model_name: str, vectors: List[List[float]]):
+    from llama_index.core import StorageContext
+
+    if not _faiss_available():
+        return StorageContext.from_defaults()
+    faiss, np, FaissVectorStore = _faiss()
+    # HNSW over 8-bit scalar-quantized vectors: 1 byte/dim instead of 4. OpenAI embeddings
+    # are unit-normalized, so inner product == cosine similarity.
+    faiss_index = faiss.IndexHNSWSQ(
+        EMBED_DIMENSIONS[embed_model_name], faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    if vectors:
+        # Learns the per-dimension value ranges used for quantization
+        faiss_index.train(np.asarray(vectors, dtype="float32"))
+    faiss_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+    return StorageContext.from_defaults(vector_store=FaissVectorStore(faiss_index=faiss_index))
+
+def _load_storage_context(persist_dir: str):
+    from llama_index.core import StorageContext
+
+    if not _faiss_available():
+        return StorageContext.from_defaults(persist_dir=persist_dir)
+    FaissVectorStore = _faiss()[2]
+    # The HNSW graph (incl. efSearch) round-trips through faiss.write_index / read_index
+    vector_store = FaissVectorStore.from_persist_dir(persist_dir)
+    return StorageContext.from_defaults(vector_store=vector_store, persist_dir=persist_dir)
+
+def _chunk_documents(documents) -> Tuple[List[TextNode], List[str]]:
+    """Chunk documents with the default node parser; returns nodes plus a parallel list of embed texts."""
+    from llama_index.core import Settings
+    from llama_index.core.schema import MetadataMode
+
+    nodes = Settings.node_parser.get_nodes_from_documents(documents)
+    texts = [n.get_content(metadata_mode=MetadataMode.EMBED) for n in nodes]
+    return nodes, texts
+
+async def _load_or_build_index(pdf_paths: List[str], embed, persist_dir: Optional[str]):
+    """Reuse the index persisted in persist_dir if there is one; otherwise embed and persist."""
+    from llama_index.core import VectorStoreIndex, load_index_from_storage
+
+    if persist_dir and os.path.exists(os.path.join(persist_dir, "docstore.json")):
+        print(f"Loading cached index from {persist_dir}...")
+        try:
+            storage_context = _load_storage_context(persist_dir)
+            return load_index_from_storage(storage_context, embed_model=embed)
+        except Exception as e:
+            print(f"Cached index is unreadable ({e!r}); rebuilding it.")
+
+    print(f"Loading {len(pdf_paths)} PDF file(s)...")
+    # Parse PDFs (CPU, worker thread) while a throwaway embedding request sets up the
+    # HTTPS connection that the batch and query embeddings reuse
+    documents, _ = await asyncio.gather(
+        asyncio.to_thread(_load_pdfs, pdf_paths),
+        embed.aget_text_embedding("warmup"),
+    )
+    nodes, texts = await asyncio.to_thread(_chunk_documents, documents)
+
+    # Embed every chunk in one batched call; nodes that already carry an embedding
+    # are inserted as-is by VectorStoreIndex
+    vectors = await embed.aget_text_embedding_batch(texts, show_progress=False)
+    for node, vector in zip(nodes, vectors):
+        node.embedding = vector
+    index = VectorStoreIndex(
+        nodes,
+        storage_context=_new_storage_context(embed.model_name, vectors),
+        embed_model=embed,
+    )
+    if persist_dir:
+        # Persist into a scratch dir and swap it in, so an interrupted write never leaves
+        # a directory that looks like a complete cache
+        tmp_dir = persist_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        index.storage_context.persist(persist_dir=tmp_dir)
+        shutil.rmtree(persist_dir, ignore_errors=True)
+        os.replace(tmp_dir, persist_dir)
+    return index
+
+_SPLITTER_CACHE: Dict[Tuple[int, int], SentenceSplitter] = {}
+
+def _get_splitter(chunk_size: int, chunk_overlap: int) -> SentenceSplitter:
+    """One SentenceSplitter per (size, overlap), built once and reused across calls."""
+    from llama_index.core.node_parser import SentenceSplitter
+
+    key = (chunk_size, chunk_overlap)
+    if key not in _SPLITTER_CACHE:
+        _SPLITTER_CACHE[key] = SentenceSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, tokenizer=_encoding().encode
+        )
+    return _SPLITTER_CACHE[key]
+
+def _source_location(meta: dict) -> Tuple[str, str]:
+    file_path = meta.get("file_path") or meta.get("filename") or meta.get("source") or "unknown"
+    page = meta.get("page_label") or meta.get("page_number") or meta.get("page") or "?"
+    return file_path, page
 
 def _split_and_number(nodes: List[NodeWithScore],
                       chunk_size: int,
                       chunk_overlap: int) -> Tuple[List[NodeWithScore], List[dict]]:
-    """Split retrieved nodes into chunks, prefix each with 'Source N:', and track a printable map."""
-    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    numbered_nodes: List[NodeWithScore] = []
-    source_map: List[dict] = []
-    counter = 1
-
-    for nws in nodes:
-        base_node = getattr(nws, "node", nws)
-        text = getattr(base_node, "get_content", None)
-        text = text() if callable(text) else getattr(base_node, "text", "") or ""
-
-        meta = getattr(base_node, "metadata", {}) or {}
-        file_path = meta.get("file_path") or meta.get("filename") or meta.get("source") or "unknown"
-        page = meta.get("page_label") or meta.get("page_number") or meta.get("page") or "?"
-
-        for chunk in splitter.split_text(text):
-            labeled_text = f"Source {counter}:\n{chunk}"
-            new_node = TextNode(
-                text=labeled_text,
-                metadata={"source_index": counter, "file_path": file_path, "page": page},
-            )
-            score = getattr(nws, "score", None)
-            numbered_nodes.append(NodeWithScore(node=new_node, score=score))
-            source_map.append({
-                "N": counter, "file_path": file_path, "page": page,
-                "score": score, "snippet": chunk[:240].replace("\n", " "),
-            })
-            counter += 1
-
+    """Split retrieved nodes into chunks, prefix each with 'Source N:', and track N -> node.
+
+    The source map only holds references; printable rows are built later by
+    _cited_source_map for the sources the answer actually cites.
+    """
+    from llama_index.core.schema import NodeWithScore, TextNode
+
+    splitter = _get_splitter(chunk_size, chunk_overlap)
+
+    # Pull per-node fields out once, then work over flat (node_index, chunk) pairs
+    base_nodes = [nws.node for nws in nodes]
+    scores = [nws.score for nws in nodes]
+    locations = [_source_location(n.metadata or {}) for n in base_nodes]
+    flat = [(i, chunk) for i, n in enumerate(base_nodes) for chunk in splitter.split_text(n.get_content())]
+
+    numbered_nodes = [
+        NodeWithScore(
+            node=TextNode(
+                text=f"Source {counter}:\n{chunk}",
+                metadata={"source_index": counter, "file_path": locations[i][0], "page": locations[i][1]},
+            ),
+            score=scores[i],
+        )
+        for counter, (i, chunk) in enumerate(flat, 1)
+    ]
+    source_map = [
+        {"N": counter, "node": nws.node, "score": nws.score}
+        for counter, nws in enumerate(numbered_nodes, 1)
+    ]
     return numbered_nodes, source_map
 
-async def answer_with_citations(pdf_paths: List[str],
-                                query: str,
-                                top_k: int,
-                                chunk_size: int,
-                                chunk_overlap: int,
-                                model: str) -> None:
-    # 1) Load docs
-    print(f"Loading {len(pdf_paths)} PDF file(s)...")
-    documents = _load_pdfs(pdf_paths)
-
-    # 2) Build index
-    embed = OpenAIEmbedding(model="text-embedding-3-small")
-    index = VectorStoreIndex.from_documents(documents, embed_model=embed)
+# One citation item: "3", "Source 3", "2-4" or "2–4"; a bracket holds one or more, comma-separated
+_CITATION_ITEM = r"(?:Source\s+)?\d+(?:\s*[-–]\s*\d+)?"
+_CITATION_RE = re.compile(rf"\[({_CITATION_ITEM}(?:\s*,\s*{_CITATION_ITEM})*)\]", re.IGNORECASE)
+_CITATION_ITEM_RE = re.compile(r"(\d+)(?:\s*[-–]\s*(\d+))?")
+
+def _cited_numbers(answer: str, max_n: int) -> set:
+    cited = set()
+    for group in _CITATION_RE.findall(answer):
+        for start, end in _CITATION_ITEM_RE.findall(group):
+            # Clamp ranges to the sources that exist so "[1-99999]" cannot blow up
+            cited.update(range(int(start), min(int(end or start), max_n) + 1))
+    return cited
+
+def _cited_source_map(source_map: List[dict], answer: str) -> List[dict]:
+    """Printable rows (file, page, score, snippet) for the sources cited in the answer.
+
+    Accepts [N], [N, M], [Source N] and [a-b] ranges; if no citation parses, every source is listed.
+    """
+    cited = _cited_numbers(answer, len(source_map))
+    rows = []
+    for s in source_map:
+        if cited and s["N"] not in cited:
+            continue
+        meta = s["node"].metadata
+        chunk = s["node"].get_content().split("\n", 1)[-1]  # drop the "Source N:" label
+        rows.append({
+            "N": s["N"], "file_path": meta["file_path"], "page": meta["page"],
+            "score": s["score"], "snippet": chunk[:240].replace("\n", " "),
+        })
+    return rows
+
+def _print_answer_header(query: Optional[str] = None) -> None:
+    print("\n" + "=" * 80)
+    print("FINAL ANSWER" if query is None else f"FINAL ANSWER: {query}")
+    print("=" * 80)
 
-    # 3) Retrieve
-    retriever = index.as_retriever(similarity_top_k=top_k)
-    retrieved = retriever.retrieve(query)
-    if not retrieved:
-        print("No results retrieved. Try increasing --top-k or check your PDFs.")
-        return
+def _print_source_map(source_map: List[dict]) -> None:
+    # Assembled first and written once instead of one print() per line
+    lines = ["", "-" * 80, "SOURCE MAP (match these to the [N] citations in the answer)", "-" * 80]
+    for s in source_map[:50]:
+        lines.append(f"[{s['N']}] file={s['file_path']} page={s['page']} score={s['score']}")
+        lines.append(f"  └─ {s['snippet']}...")
+    if len(source_map) > 50:
+        lines.append(f"...and {len(source_map) - 50} more chunks.")
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
 
-    # 4) Split & number
-    numbered_nodes, source_map = _split_and_number(retrieved, chunk_size, chunk_overlap)
+def _make_synthesizer(llm, single_shot: bool):
+    # --- LlamaIndex imports with compatibility fallbacks ---
+    from llama_index.core import PromptTemplate
+    try:
+        # get_response_synthesizer lives here on modern versions
+        from llama_index.core.response_synthesizers import get_response_synthesizer
+        try:
+            # Some versions still expose ResponseMode here
+            from llama_index.core.response_synthesizers import ResponseMode  # type: ignore
+        except Exception:
+            ResponseMode = None  # we'll pass a string instead
+    except Exception:
+        # Older fallback
+        from llama_index.core import get_response_synthesizer  # type: ignore
+        ResponseMode = None
 
-    # 5) Synthesize with strict citation prompts
-    llm = OpenAI(model=model)
     synth_kwargs = dict(
         llm=llm,
-        text_qa_template=CITATION_QA_TEMPLATE,
-        refine_template=CITATION_REFINE_TEMPLATE,
+        text_qa_template=PromptTemplate(CITATION_QA_PROMPT),
         use_async=True,
+        streaming=True,
     )
+    if single_shot:
+        # Whole context fits in one prompt: a single QA call, no refine loop
+        mode = "simple_summarize"
+    else:
+        mode = "compact"
+        synth_kwargs["refine_template"] = PromptTemplate(CITATION_REFINE_PROMPT)
     # Prefer enum if available; otherwise pass a string (works on modern versions)
-    if ResponseMode is not None:
-        synth_kwargs["response_mode"] = ResponseMode.COMPACT  # type: ignore
+    synth_kwargs["response_mode"] = ResponseMode(mode) if ResponseMode is not None else mode  # type: ignore
+    return get_response_synthesizer(**synth_kwargs)
+
+async def _collect_response(resp, echo: bool) -> str:
+    """Drain a (possibly streaming) response into text, echoing tokens as they arrive if asked."""
+    if hasattr(resp, "async_response_gen"):
+        tokens = []
+        async for token in resp.async_response_gen():
+            tokens.append(token)
+            if echo:
+                print(token, end="", flush=True)
+    elif getattr(resp, "response_gen", None) is not None:
+        # Older versions hand back a sync generator even from asynthesize
+        tokens = []
+        for token in resp.response_gen:
+            tokens.append(token)
+            if echo:
+                print(token, end="", flush=True)
     else:
-        synth_kwargs["response_mode"] = "compact"
+        # Non-streaming fallback (e.g. "Empty Response" when there is nothing to synthesize)
+        tokens = [getattr(resp, "response", None) or getattr(resp, "text", None) or str(resp)]
+        if echo:
+            print(tokens[0], end="")
+    if echo:
+        print()
+    return "".join(tokens)
+
+def _context_tokens(numbered_nodes: List[NodeWithScore]) -> int:
+    """Tokens of the context as the synthesizer sends it (LLM metadata header included)."""
+    from llama_index.core.schema import MetadataMode
+
+    context = "\n".join(n.node.get_content(metadata_mode=MetadataMode.LLM) for n in numbered_nodes)
+    return len(_encoding().encode(context))
+
+def _single_shot_budget(llm, query: str) -> int:
+    """Context tokens that fit in one QA prompt next to the template, the query and the reserved output.
+
+    simple_summarize truncates whatever does not fit, so anything above this must go through refine.
+    """
+    meta = llm.metadata
+    overhead = (len(_encoding().encode(CITATION_QA_PROMPT)) + len(_encoding().encode(query))
+                + SINGLE_SHOT_MARGIN_TOKENS)
+    return min(SINGLE_SHOT_CONTEXT_TOKENS, meta.context_window - max(meta.num_output, 0) - overhead)
+
+async def _answer_one(query: str,
+                      retriever,
+                      llm,
+                      chunk_size: int,
+                      chunk_overlap: int,
+                      stream: bool,
+                      reranker=None) -> Optional[Tuple[str, List[dict]]]:
+    """Retrieve, number and synthesize one query; returns None if nothing was retrieved.
+
+    With stream=True the answer and source map are printed as they are produced.
+    """
+    # 3) Retrieve
+    retrieved = await retriever.aretrieve(query)
+    if not retrieved:
+        return None
+    if reranker is not None:
+        # Cross-encoder keeps only the best top_k candidates, so fewer chunks reach the LLM
+        retrieved = await asyncio.to_thread(reranker.postprocess_nodes, retrieved, query_str=query)
 
-    synthesizer = get_response_synthesizer(**synth_kwargs)
-    print("Generating answer...")
+    # 4) Split & number
+    numbered_nodes, source_map = _split_and_number(retrieved, chunk_size, chunk_overlap)
+
+    # 5) Synthesize with strict citation prompts
+    ctx_tokens = _context_tokens(numbered_nodes)
+    single_shot = ctx_tokens <= _single_shot_budget(llm, query)
+    prefix = "" if stream else f"[{query}] "
+    print(f"{prefix}Synthesis mode: {'simple_summarize' if single_shot else 'compact'} "
+          f"(~{ctx_tokens} context tokens)")
+    synthesizer = _make_synthesizer(llm, single_shot)
+    if stream:
+        print("Generating answer...")
     resp = await synthesizer.asynthesize(query, nodes=numbered_nodes)
 
-    # 6) Print final answer
-    print("\n" + "=" * 80)
-    print("FINAL ANSWER")
-    print("=" * 80)
-    final_text = getattr(resp, "response", None) or getattr(resp, "text", None) or str(resp)
-    print(final_text)
+    # 6) Stream final answer as tokens arrive; 7) show mapping for [N] → file/page
+    if stream:
+        _print_answer_header()
+    final_text = await _collect_response(resp, echo=stream)
+    cited_map = _cited_source_map(source_map, final_text)
+    if stream:
+        _print_source_map(cited_map)
+    return final_text, cited_map
 
-    # 7) Show mapping for [N] → file/page
-    print("\n" + "-" * 80)
-    print("SOURCE MAP (match these to the [N] citations in the answer)")
-    print("-" * 80)
-    for s in source_map[:50]:
-        print(f"[{s['N']}] file={s['file_path']} page={s['page']} score={s['score']}")
-        print(f"  └─ {s['snippet']}...")
-    if len(source_map) > 50:
-        print(f"...and {len(source_map) - 50} more chunks.")
+async def answer_with_citations(pdf_paths: List[str],
+                                queries: List[str],
+                                top_k: int,
+                                chunk_size: int,
+                                chunk_overlap: int,
+                                model: str,
+                                cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                                query_cache_ttl: float = QUERY_CACHE_TTL,
+                                rerank_model: Optional[str] = None) -> None:
+    queries = list(dict.fromkeys(queries))
+    # A single query streams to stdout; several run concurrently and print in order when done
+    stream = len(queries) == 1
+
+    persist_dir = query_cache = None
+    query_keys: Dict[str, str] = {}
+    results: Dict[str, Optional[Tuple[str, List[dict]]]] = {}
+    if cache_dir:
+        index_key = _index_cache_key(pdf_paths, EMBED_MODEL)
+        persist_dir = os.path.join(cache_dir, index_key)
+
+        # 0) Same question over the same PDFs and settings: answer from the query cache
+        query_cache = QueryCache(os.path.join(cache_dir, "query.db"))
+        for q in queries:
+            query_keys[q] = _query_cache_key(
+                q, top_k, chunk_size, chunk_overlap, model, index_key, rerank_model
+            )
+            hit = query_cache.get(query_keys[q])
+            if hit is not None:
+                results[q] = hit
+    cached = set(results)
+    pending = [q for q in queries if q not in cached]
+
+    if pending:
+        # Heavy imports happen only here, so query-cache hits never pay for them
+        from llama_index.core import Settings
+        from llama_index.llms.openai import OpenAI
+
+        Settings.tokenizer = _encoding().encode
+        async with _make_http_client() as http_client:
+            # 1-2) Load docs and build index (or reuse the cached one)
+            embed = _make_embed_model(cache_dir, http_client)
+            index = await _load_or_build_index(pdf_paths, embed, persist_dir)
+            reranker = None
+            if rerank_model:
+                from llama_index.core.postprocessor import SentenceTransformerRerank
+                reranker = await asyncio.to_thread(SentenceTransformerRerank, model=rerank_model, top_n=top_k)
+            retriever = index.as_retriever(similarity_top_k=top_k * RERANK_CANDIDATES if reranker else top_k)
+            llm = OpenAI(model=model, async_http_client=http_client)
+            sem = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+            async def _bounded(q: str):
+                async with sem:
+                    return await _answer_one(
+                        q, retriever, llm, chunk_size, chunk_overlap, stream, reranker
+                    )
+
+            if not stream:
+                print(f"Generating answers for {len(pending)} queries...")
+            answers = await asyncio.gather(*(_bounded(q) for q in pending))
+            results.update(zip(pending, answers))
+
+    for q in queries:
+        result = results[q]
+        if result is None:
+            prefix = "" if stream else f"[{q}] "
+            print(f"{prefix}No results retrieved. Try increasing --top-k or check your PDFs.")
+            continue
+        if q in cached:
+            print("Answer served from the query cache.")
+        elif stream:
+            continue  # already printed while streaming
+        final_text, source_map = result
+        _print_answer_header(None if stream else q)
+        print(final_text)
+        _print_source_map(source_map)
+
+    if query_cache is not None:
+        for q in pending:
+            if results[q] is not None:
+                query_cache.put(query_keys[q], results[q], ttl=query_cache_ttl)
+        query_cache.save()
 
 def main():
-    if not os.environ.get("OPENAI_API_KEY"):
-        print("Error: OPENAI_API_KEY is not set. Example:")
-        print("  export OPENAI_API_KEY='sk-...'")
-        sys.exit(1)
-
     parser = argparse.ArgumentParser(description="Answer questions over local PDF(s) with inline [N] citations.")
     parser.add_argument("--pdf", nargs="+", required=True, help="Path(s) to one or more PDF files.")
-    parser.add_argument("--query", required=True, help="Your question.")
+    query_group = parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument("--query", help="Your question.")
+    query_group.add_argument("--queries", nargs="+", help="Several questions, answered concurrently over the same index.")
     parser.add_argument("--top-k", type=int, default=5, help="Retriever top_k (default: 5).")
     parser.add_argument("--chunk-size", type=int, default=CITATION_CHUNK_SIZE, help="Chunk size for citation nodes.")
     parser.add_argument("--chunk-overlap", type=int, default=CITATION_CHUNK_OVERLAP, help="Chunk overlap for citation nodes.")
     parser.add_argument("--model", default="gpt-5-nano", help="OpenAI chat model (default: gpt-5-nano).")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help=f"Directory for the on-disk index cache (default: {DEFAULT_CACHE_DIR}).")
+    parser.add_argument("--no-cache", action="store_true", help="Always re-embed the PDFs and re-ask the model; do not read or write the cache.")
+    parser.add_argument("--query-cache-ttl", type=float, default=QUERY_CACHE_TTL, help=f"Seconds a cached answer is reused for the same query (default: {QUERY_CACHE_TTL}).")
+    parser.add_argument("--rerank", nargs="?", const=RERANK_MODEL, default=None, metavar="MODEL",
+                        help=f"Rerank {RERANK_CANDIDATES}x top-k candidates with a cross-encoder and keep the best top-k "
+                             f"(default model: {RERANK_MODEL}; needs sentence-transformers).")
     args = parser.parse_args()
 
+    if not os.environ.get("OPENAI_API_KEY"):
+        print("Error: OPENAI_API_KEY is not set. Example:")
+        print("  export OPENAI_API_KEY='sk-...'")
+        sys.exit(1)
+
+    try:
+        pdfs = [_resolve_pdf(p) for p in args.pdf]
+    except OSError as e:
+        print(f"Error: cannot access PDF {e.filename}: {e.strerror}")
+        sys.exit(1)
+
     try:
         asyncio.run(
             answer_with_citations(
-                pdf_paths=args.pdf,
-                query=args.query,
+                pdf_paths=pdfs,
+                queries=args.queries or [args.query],
                 top_k=args.top_k,
                 chunk_size=args.chunk_size,
                 chunk_overlap=args.chunk_overlap,
                 model=args.model,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                query_cache_ttl=args.query_cache_ttl,
+                rerank_model=args.rerank,
             )
         )
     except KeyboardInterrupt: